@@ -1,14 +1,26 @@
 from fastapi import FastAPI, HTTPException, Body, Query, Depends
 from fastapi.middleware.cors import CORSMiddleware
-import time, requests, json, os
-from typing import Dict, List
+from fastapi.responses import StreamingResponse, FileResponse
+from starlette.background import BackgroundTask
+import time, requests, json, os, csv, io, tempfile, hashlib, threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
 from functools import lru_cache
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError, ProgrammingError
 from sqlalchemy.orm import Session
 from db.session import SessionLocal
 from db.models import Offer
 from dateutil import parser
 
-app = FastAPI(title="OLX Offer Tracker API (In-Memory)")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warm_seen_offers()
+    yield
+
+app = FastAPI(title="OLX Offer Tracker API (In-Memory)", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -19,9 +31,25 @@ app.add_middleware(
 
 observations: Dict[str, Dict] = {}
 offers: Dict[str, List[Dict]] = {}
+# Global seen-offer index shared by all observations and categories
+seen_offers: Dict[str, tuple] = {}  # offer id -> (content fingerprint, stored categoryId)
+seen_lock = threading.Lock()
+formatted_offers: OrderedDict = OrderedDict()  # offer id -> (fingerprint, photo link, formatted offer), LRU
+formatted_lock = threading.Lock()
 
 HEADERS = {"User-Agent": "Mozilla/5.0"}
 
+SEEN_INDEX_BATCH_SIZE = 1000
+# ~200 bytes per index entry in CPython, so the warm-up holds ~20 MB at most;
+# older offers are checked against the DB on their first miss instead
+SEEN_INDEX_WARM_LIMIT = 100_000
+FORMATTED_CACHE_SIZE = 5000
+OFFER_CONTENT_FIELDS = ["last_refresh_time", "title", "description", "url", "value", "previous_value", "stan"]
+
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_COLUMNS = ["id", "last_refresh_time", "title", "description", "url", "filters", "value", "previous_value", "stan"]
+EXPORT_PARQUET_TYPES = {"value": "float64", "previous_value": "float64"}  # other columns are strings
+
 def get_db():
     db = SessionLocal()
     try:
@@ -94,24 +122,100 @@ def find_matching_olx_offers(obs: dict) -> list[dict]:
             offers.append(raw)
     return offers
 
+def _price_values(o: dict) -> tuple:
+    price_val = None
+    prev_price_val = None
+    for p in o.get("params", []):
+        if p["key"] == "price":
+            try:
+                price_val = float(p["value"].get("value", 0))
+                prev_price_val = float(p["value"].get("previous_value", 0)) if p["value"].get("previous_value") else None
+            except Exception:
+                pass
+    return price_val, prev_price_val
+
+def _offer_content(o: dict) -> dict:
+    # Columns describing the offer itself, independent of the observation that found it
+    last_refresh_time_str = o.get("last_refresh_time")
+    price_val, prev_price_val = _price_values(o)
+    return {
+        "last_refresh_time": parser.parse(last_refresh_time_str) if last_refresh_time_str else None,
+        "title": o.get("title"),
+        "description": o.get("description"),
+        "url": o.get("url"),
+        "value": price_val,
+        "previous_value": prev_price_val,
+        "stan": next((p["value"].get("key") for p in o.get("params", []) if p["key"] == "state"), None),
+    }
+
+def _offer_filters(obs: dict) -> dict:
+    return {k: v for k, v in obs.items() if k not in ["id", "offers", "lastChecked"]}
+
+def _offer_fingerprint(content: dict) -> bytes:
+    last_refresh_time = content["last_refresh_time"]
+    # SQLite drops the UTC offset, so compare naive datetimes on both sides
+    if last_refresh_time is not None:
+        last_refresh_time = last_refresh_time.replace(tzinfo=None).isoformat()
+    payload = json.dumps([last_refresh_time] + [content[k] for k in OFFER_CONTENT_FIELDS[1:]], ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).digest()
+
+def warm_seen_offers():
+    db = SessionLocal()
+    try:
+        columns = [getattr(Offer, k) for k in OFFER_CONTENT_FIELDS]
+        rows = (
+            db.query(Offer.id, Offer.filters, *columns)
+            .order_by(Offer.last_refresh_time.desc())
+            .limit(SEEN_INDEX_WARM_LIMIT)
+            .yield_per(SEEN_INDEX_BATCH_SIZE)
+        )
+        for row in rows:
+            content = {k: getattr(row, k) for k in OFFER_CONTENT_FIELDS}
+            seen_offers[row.id] = (_offer_fingerprint(content), (row.filters or {}).get("categoryId"))
+    except (OperationalError, ProgrammingError) as e:
+        # Fresh database without the offers table yet, start with an empty index
+        seen_offers.clear()
+        print(f"Seen-offer index not warmed: {e}")
+    finally:
+        db.close()
+
+def _photo_link(o: dict) -> str:
+    return o.get("photos", [{}])[0].get("link", "") if o.get("photos") else ""
+
+def _format_offer(o: dict) -> dict:
+    img = _photo_link(o)
+    if ";s={width}x{height}" in img:
+        img = img.replace(";s={width}x{height}", ";s=400x400")
+    price = next((p["value"]["label"] for p in o.get("params", []) if p["key"] == "price"), "-")
+    return {
+        "id": o["id"],
+        "title": o["title"],
+        "url": o["url"],
+        "price": price,
+        "imageUrl": img,
+        "timestamp": int(time.time() * 1000),
+        "lastRefreshTime": o.get("last_refresh_time"),
+        "isNew": True,
+    }
+
+def _format_offer_cached(o: dict, fingerprint: bytes) -> dict:
+    # Known offers reuse their formatted entry and only get a fresh timestamp
+    photo = _photo_link(o)
+    with formatted_lock:
+        cached = formatted_offers.get(o["id"])
+        if cached and cached[0] == fingerprint and cached[1] == photo:
+            formatted_offers.move_to_end(o["id"])
+            return {**cached[2], "timestamp": int(time.time() * 1000)}
+    formatted = _format_offer(o)
+    with formatted_lock:
+        formatted_offers[o["id"]] = (fingerprint, photo, formatted)
+        formatted_offers.move_to_end(o["id"])
+        while len(formatted_offers) > FORMATTED_CACHE_SIZE:
+            formatted_offers.popitem(last=False)
+    return dict(formatted)
+
 def format_offers(offers_raw: list[dict]) -> list[dict]:
-    formatted = []
-    for o in offers_raw:
-        img = o.get("photos", [{}])[0].get("link", "") if o.get("photos") else ""
-        if ";s={width}x{height}" in img:
-            img = img.replace(";s={width}x{height}", ";s=400x400")
-        price = next((p["value"]["label"] for p in o.get("params", []) if p["key"] == "price"), "-")
-        formatted.append({
-            "id": o["id"],
-            "title": o["title"],
-            "url": o["url"],
-            "price": price,
-            "imageUrl": img,
-            "timestamp": int(time.time() * 1000),
-            "lastRefreshTime": o.get("last_refresh_time"),
-            "isNew": True,
-        })
-    return formatted
+    return [_format_offer_cached(o, _offer_fingerprint(_offer_content(o))) for o in offers_raw]
 
 @app.get("/api/observations")
 def list_observations():
@@ -151,22 +255,7 @@ def update_observation(obs_id: str, data: Dict = Body(...)):
             obs[k] = v.strip() if isinstance(v, str) else v
     observations[obs_id] = obs
     fresh = find_matching_olx_offers(obs)
-    new_offers = []
-    for o in fresh:
-        img = o.get("photos", [{}])[0].get("link", "") if o.get("photos") else ""
-        if ";s={width}x{height}" in img:
-            img = img.replace(";s={width}x{height}", ";s=400x400")
-        price = next((p["value"]["label"] for p in o.get("params", []) if p["key"] == "price"), "-")
-        new_offers.append({
-            "id": o["id"],
-            "title": o["title"],
-            "url": o["url"],
-            "price": price,
-            "imageUrl": img,
-            "timestamp": int(time.time() * 1000),
-            "lastRefreshTime": o.get("last_refresh_time"),
-            "isNew": True,
-        })
+    new_offers = format_offers(fresh)
     # Merge new offers with cached offers, keeping unique by ID
     cached = {o['id']: o for o in offers.get(obs_id, [])}
     for o in new_offers:
@@ -187,70 +276,46 @@ def refresh_observation(obs_id: str, db: Session = Depends(get_db)):
     if not obs.get("categoryId"):
         raise HTTPException(status_code=400, detail="categoryId is required for this observation")
     fresh = find_matching_olx_offers(obs)
+    category = obs["categoryId"]
+    filters = _offer_filters(obs)
     new_offers = []
+    pending_seen = {}
     for o in fresh:
-        img = o.get("photos", [{}])[0].get("link", "") if o.get("photos") else ""
-        if ";s={width}x{height}" in img:
-            img = img.replace(";s={width}x{height}", ";s=400x400")
-        price = next((p["value"]["label"] for p in o.get("params", []) if p["key"] == "price"), "-")
-        price_val = None
-        prev_price_val = None
-        for p in o.get("params", []):
-            if p["key"] == "price":
-                try:
-                    price_val = float(p["value"].get("value", 0))
-                    prev_price_val = float(p["value"].get("previous_value", 0)) if p["value"].get("previous_value") else None
-                except Exception:
-                    pass
-        stan = next((p["value"].get("key") for p in o.get("params", []) if p["key"] == "state"), None)
         offer_id = o["id"]
-        # Parse last_refresh_time to datetime
-        last_refresh_time_str = o.get("last_refresh_time")
-        last_refresh_time = parser.parse(last_refresh_time_str) if last_refresh_time_str else None
+        content = _offer_content(o)
+        fingerprint = _offer_fingerprint(content)
+        new_offers.append(_format_offer_cached(o, fingerprint))
+        seen = seen_offers.get(offer_id)
+        if seen and seen[0] == fingerprint:
+            # Known offer with unchanged content, only move it to this category if needed
+            if seen[1] != category:
+                db.query(Offer).filter(Offer.id == offer_id).update({"filters": filters})
+                pending_seen[offer_id] = (fingerprint, category)
+            continue
+        pending_seen[offer_id] = (fingerprint, category)
         # Upsert offer in DB
         db_offer = db.query(Offer).filter(Offer.id == offer_id).first()
         if db_offer:
-            # Update existing offer
-            db_offer.last_refresh_time = last_refresh_time
-            db_offer.title = o.get("title")
-            db_offer.description = o.get("description")
-            db_offer.url = o.get("url")
-            db_offer.filters = {k: v for k, v in obs.items() if k not in ["id", "offers", "lastChecked"]}
-            db_offer.value = price_val
-            db_offer.previous_value = prev_price_val
-            db_offer.stan = stan
+            # Update existing offer, skipping content that is already stored
+            stored = _offer_fingerprint({k: getattr(db_offer, k) for k in OFFER_CONTENT_FIELDS})
+            if stored != fingerprint:
+                for k, v in content.items():
+                    setattr(db_offer, k, v)
+            if (db_offer.filters or {}).get("categoryId") != category:
+                db_offer.filters = filters
         else:
             # Create new offer
-            db_offer = Offer(
-                id=offer_id,
-                last_refresh_time=last_refresh_time,
-                title=o.get("title"),
-                description=o.get("description"),
-                url=o.get("url"),
-                filters={k: v for k, v in obs.items() if k not in ["id", "offers", "lastChecked"]},
-                value=price_val,
-                previous_value=prev_price_val,
-                stan=stan
-            )
-            db.add(db_offer)
-        
-        new_offers.append({
-            "id": o["id"],
-            "title": o["title"],
-            "url": o["url"],
-            "price": price,
-            "imageUrl": img,
-            "timestamp": int(time.time() * 1000),
-            "lastRefreshTime": o.get("last_refresh_time"),
-            "isNew": True,
-        })
+            db.add(Offer(id=offer_id, filters=filters, **content))
     
-    try:
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        print(f"Database error: {e}")
-        # Continue without failing the entire request
+    # Commit and index update happen together so the index follows the DB commit order
+    with seen_lock:
+        try:
+            db.commit()
+            seen_offers.update(pending_seen)
+        except Exception as e:
+            db.rollback()
+            print(f"Database error: {e}")
+            # Continue without failing the entire request
     # Merge new offers with cached offers, keeping unique by ID
     cached = {o['id']: o for o in offers.get(obs_id, [])}
     for o in new_offers:
@@ -303,7 +368,7 @@ def get_category_filters(categoryId: int = Query(...)):
 def get_sample_offers(categoryId: int = Query(...)):
     try:
         offers_raw = _query_olx_api(categoryId, limit=10)
-        return format_offers(offers_raw)
+        return [_format_offer(o) for o in offers_raw]
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -334,20 +399,112 @@ def get_offer(offer_id: str, db: Session = Depends(get_db)):
 def get_offers_by_observation(observation_id: str, db: Session = Depends(get_db)):
     # Find all offers where filters['categoryId'] == observation_id
     offers = db.query(Offer).filter(Offer.filters["categoryId"].as_string() == observation_id).all()
-    return [
-        {
-            "id": o.id,
-            "last_refresh_time": o.last_refresh_time,
-            "title": o.title,
-            "description": o.description,
-            "url": o.url,
-            "filters": o.filters,
-            "value": o.value,
-            "previous_value": o.previous_value,
-            "stan": o.stan,
-        }
-        for o in offers
-    ]
+    return [_export_row(o) for o in offers]
+
+def _export_query(category_id, date_from, date_to, price_min, price_max):
+    stmt = select(Offer)
+    if category_id:
+        stmt = stmt.where(Offer.filters["categoryId"].as_string() == category_id)
+    if date_from:
+        stmt = stmt.where(Offer.last_refresh_time >= date_from)
+    if date_to:
+        stmt = stmt.where(Offer.last_refresh_time <= date_to)
+    if price_min is not None:
+        stmt = stmt.where(Offer.value >= price_min)
+    if price_max is not None:
+        stmt = stmt.where(Offer.value <= price_max)
+    # yield_per streams rows through a server-side cursor in fixed-size batches
+    return stmt.order_by(Offer.id).execution_options(yield_per=EXPORT_CHUNK_SIZE)
+
+def _export_row(o: Offer) -> dict:
+    row = {c: getattr(o, c) for c in EXPORT_COLUMNS}
+    if row["last_refresh_time"]:
+        row["last_refresh_time"] = row["last_refresh_time"].isoformat()
+    return row
+
+def _export_chunks(filters: dict):
+    # Own session: the request-scoped one may be closed before the body is streamed
+    db = SessionLocal()
+    try:
+        # With yield_per set, each partition is one fetched batch
+        for batch in db.execute(_export_query(**filters)).scalars().partitions():
+            yield [_export_row(o) for o in batch]
+    finally:
+        db.close()
+
+def _stream_ndjson(filters: dict):
+    for chunk in _export_chunks(filters):
+        yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in chunk)
+
+def _stream_csv(filters: dict):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for chunk in _export_chunks(filters):
+        for row in chunk:
+            writer.writerow({**row, "filters": json.dumps(row["filters"], ensure_ascii=False)})
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+    if buf.tell():
+        yield buf.getvalue()
+
+def _write_parquet(filters: dict) -> str:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Parquet export requires pyarrow to be installed")
+    schema = pa.schema([(c, getattr(pa, EXPORT_PARQUET_TYPES.get(c, "string"))()) for c in EXPORT_COLUMNS])
+    fd, path = tempfile.mkstemp(suffix=".parquet")
+    os.close(fd)
+    try:
+        with pq.ParquetWriter(path, schema) as writer:
+            for chunk in _export_chunks(filters):
+                rows = [{**row, "filters": json.dumps(row["filters"], ensure_ascii=False)} for row in chunk]
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+@app.get("/api/offers-export")
+def export_offers(
+    fmt: str = Query("ndjson", alias="format"),
+    categoryId: Optional[str] = Query(None),
+    dateFrom: Optional[datetime] = Query(None),
+    dateTo: Optional[datetime] = Query(None),
+    priceMin: Optional[float] = Query(None),
+    priceMax: Optional[float] = Query(None),
+):
+    filters = {
+        "category_id": categoryId,
+        "date_from": dateFrom,
+        "date_to": dateTo,
+        "price_min": priceMin,
+        "price_max": priceMax,
+    }
+    if fmt == "ndjson":
+        return StreamingResponse(
+            _stream_ndjson(filters),
+            media_type="application/x-ndjson",
+            headers={"Content-Disposition": "attachment; filename=offers.ndjson"},
+        )
+    if fmt == "csv":
+        return StreamingResponse(
+            _stream_csv(filters),
+            media_type="text/csv",
+            headers={"Content-Disposition": "attachment; filename=offers.csv"},
+        )
+    if fmt == "parquet":
+        path = _write_parquet(filters)
+        return FileResponse(
+            path,
+            media_type="application/vnd.apache.parquet",
+            filename="offers.parquet",
+            background=BackgroundTask(os.remove, path),
+        )
+    raise HTTPException(status_code=400, detail="format must be one of: ndjson, csv, parquet")
 
 if __name__ == "__main__":
     import uvicorn